@@ -4,16 +4,14 @@ import glob
 import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
-import tensorflow_hub as hub
 import os
 import cv2
 import h5py
-import json
-import io
-from collections import defaultdict
-import random
-from copy import deepcopy
-from PIL import Image
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+import queue
+import threading
 
 CAMERA_TYPE_DICT = {
     'wrist_camera_id': 0,
@@ -25,6 +23,37 @@ CAMERA_TYPE_TO_STRING_DICT = {
     1: "static_camera",
 }
 
+# Images are resized to this (W, H) by the MP4 readers right after decoding, downsampled from (640, 480).
+IMAGE_RESOLUTION = (360, 270)
+JPEG_QUALITY = 95
+
+# (name, width) of the low-dimensional fields of each step, in column order of the per-episode float32 buffer.
+LOW_DIM_FIELDS = [
+    ('obs_cartesian_position', 6),
+    ('obs_joint_position', 7),
+    ('obs_gripper_position', 1),
+    ('action_cartesian_position', 6),
+    ('action_cartesian_velocity', 6),
+    ('action_gripper_position', 1),
+    ('action_gripper_velocity', 1),
+    ('action_joint_position', 7),
+    ('action_joint_velocity', 7),
+    ('action_all', 7),
+]
+
+# Decoder threads per video. Episodes are already parsed in one process per core and the four cameras of an episode
+# are decoded concurrently, so every core is already busy and more threads would only oversubscribe the CPU.
+VIDEO_DECODE_THREADS = 1
+
+# Set to "cuda" to decode RGB videos with NVDEC via torchcodec (falls back to OpenCV if unavailable).
+VIDEO_DECODE_DEVICE = "cpu"
+
+# Every episode worker process creates its own CUDA context, so use fewer workers when decoding on the GPU.
+CUDA_DECODE_WORKERS = 2
+
+# Frames decoded on the GPU per batch, which bounds the number of full resolution frames held in GPU memory.
+CUDA_DECODE_BATCH_SIZE = 16
+
 
 def get_camera_type(cam_id):
     if cam_id not in CAMERA_TYPE_DICT:
@@ -34,15 +63,30 @@ def get_camera_type(cam_id):
     return type_str
 
 
+def cuda_decode_available():
+    # torch is slow to import, so only import it when GPU decoding is actually requested
+    try:
+        import torch
+        import torchcodec.decoders
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
 class MP4Reader:
-    def __init__(self, filepath, serial_number, grayscale=False):
+    def __init__(self, filepath, serial_number, grayscale=False, device="cpu"):
         # Save Parameters #
+        self.filepath = filepath
         self.serial_number = serial_number
         self.grayscale = grayscale
+        self.device = device if (device == "cpu" or cuda_decode_available()) else "cpu"
         self._index = 0
 
-        # Open Video Reader #
-        self._mp4_reader = cv2.VideoCapture(filepath)
+        # Open Video Reader (Older OpenCV Versions Can't Set The Decoder Thread Count, So Use Their Default) #
+        if hasattr(cv2, "CAP_PROP_N_THREADS"):
+            self._mp4_reader = cv2.VideoCapture(filepath, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, VIDEO_DECODE_THREADS])
+        else:
+            self._mp4_reader = cv2.VideoCapture(filepath)
         if not self._mp4_reader.isOpened():
             raise RuntimeError("Corrupted MP4 File")
 
@@ -74,40 +118,57 @@ class MP4Reader:
         if self.skip_reading:
             return
 
-        if index < self._index:
-            self._mp4_reader.set(cv2.CAP_PROP_POS_FRAMES, index - 1)
-            self._index = index
+        # Frames are always read in increasing order, so never seek backwards (keyframe seeks are expensive) #
+        assert index >= self._index, f"Cannot seek backwards from frame {self._index} to frame {index}"
 
+        # Grab (without decoding) frames until the target frame #
         while self._index < index:
-            self.read_camera(ignore_data=True)
-
-    def _process_frame(self, frame):
-        frame = deepcopy(frame)
-        return frame
+            self._mp4_reader.grab()
+            self._index += 1
 
-    def read_camera(self, ignore_data=False, correct_timestamp=None):
-        # Skip if Read Unnecesary #
-        if self.skip_reading:
-            return {}
-
-        # Read Camera #
-        success, frame = self._mp4_reader.read()
-        if self.grayscale:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) # convert to 1-channel image
-        else:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) # convert to RGB
+    def iter_frames(self, indices):
+        # Decode On The GPU If Requested (Depth Videos Stay On The CPU) #
+        if self.device == "cuda" and not self.grayscale:
+            yield from self._iter_frames_cuda(indices)
+            return
 
-        self._index += 1
-        if not success:
-            return None
-        if ignore_data:
-            return None
+        # Read All Requested (BGR) Frames In A Single Forward Pass, Stopping At The First Failure #
+        # Skipped frames are only grabbed, and requested frames are decoded (and resized) one at a time.
+        for index in indices:
+            self.set_frame_index(index)
+            success = self._mp4_reader.grab()
+            self._index += 1
+            if not success:
+                return
+            success, frame = self._mp4_reader.retrieve()
+            if not success:
+                return
+            frame = self._process_frame(frame)
+            if self.grayscale:
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) # convert to 1-channel image
+            else:
+                yield frame[..., ::-1] # RGB view of the BGR frame, without copying
 
-        # Return Data #
-        data_dict = {}
-        data_dict["image"] = {self.serial_number: self._process_frame(frame)}
+    def _process_frame(self, frame):
+        # Resize Right After Decoding, So Full Resolution Frames Are Never Kept Around #
+        if tuple(self.resolution) != (0, 0):
+            frame = cv2.resize(frame, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+        return frame
 
-        return data_dict
+    def _iter_frames_cuda(self, indices):
+        import torch
+        from torchcodec.decoders import VideoDecoder
+
+        # Decode (And Resize) In Bounded Batches, Then Hand Frames Out One At A Time #
+        decoder = VideoDecoder(self.filepath, device="cuda")
+        num_frames = decoder.metadata.num_frames
+        indices = [int(index) for index in indices if index < num_frames]
+        for start in range(0, len(indices), CUDA_DECODE_BATCH_SIZE):
+            frames = decoder.get_frames_at(indices=indices[start:start + CUDA_DECODE_BATCH_SIZE]).data # (N, C, H, W) RGB
+            if tuple(self.resolution) != (0, 0):
+                width, height = self.resolution
+                frames = torch.nn.functional.interpolate(frames.float(), size=(height, width), mode="area").round()
+            yield from frames.permute(0, 2, 3, 1).to("cpu", torch.uint8).numpy()
 
     def disable_camera(self):
         if hasattr(self, "_mp4_reader"):
@@ -115,7 +176,7 @@ class MP4Reader:
 
 
 class RecordedMultiCameraWrapper:
-    def __init__(self, recording_folderpath, camera_kwargs={}):
+    def __init__(self, recording_folderpath, camera_kwargs={}, camera_type_dict={}, device="cpu"):
         # Save Camera Info #
         self.camera_kwargs = camera_kwargs
 
@@ -127,116 +188,120 @@ class RecordedMultiCameraWrapper:
         self.camera_dict = {}
         for f in all_filepaths:
             serial_number = f.split("/")[-1][:-4]
-            cam_type = get_camera_type(serial_number)
-            camera_kwargs.get(cam_type, {})
+            cam_type = camera_type_dict.get(serial_number, get_camera_type(serial_number))
+            curr_cam_kwargs = camera_kwargs.get(cam_type, {})
 
             if f.endswith("_depth.mp4"):
-                self.camera_dict[serial_number] = MP4Reader(f, serial_number, grayscale=True) # depth is black and white
+                self.camera_dict[serial_number] = MP4Reader(f, serial_number, grayscale=True, device=device) # depth is black and white
             elif f.endswith(".mp4"):
-                self.camera_dict[serial_number] = MP4Reader(f, serial_number)
+                self.camera_dict[serial_number] = MP4Reader(f, serial_number, device=device)
             else:
                 raise ValueError
 
+            # Reading parameters are fixed for the whole trajectory, so set them once #
+            self.camera_dict[serial_number].set_reading_parameters(**curr_cam_kwargs)
 
-    def read_cameras(self, index=None, camera_type_dict={}, timestamp_dict={}):
-        full_obs_dict = defaultdict(dict)
 
-        # Read Cameras In Randomized Order #
-        all_cam_ids = list(self.camera_dict.keys())
-        #random.shuffle(all_cam_ids)
+    def iter_cameras(self, indices):
+        # Yield The Images Of All Cameras One Index At A Time, Stopping If Any Camera Fails #
+        # Each camera decodes its next frame in its own thread (OpenCV releases the GIL while decoding).
+        frame_iters = {
+            cam_id: reader.iter_frames(indices) for cam_id, reader in self.camera_dict.items() if not reader.skip_reading
+        }
+        with ThreadPoolExecutor(max_workers=max(1, len(frame_iters))) as executor:
+            for _ in indices:
+                futures = {cam_id: executor.submit(next, frames, None) for cam_id, frames in frame_iters.items()}
+                images = {cam_id: future.result() for cam_id, future in futures.items()}
+                if any(image is None for image in images.values()):
+                    return
+                yield images
 
-        for cam_id in all_cam_ids:
-            cam_type = camera_type_dict[cam_id]
-            curr_cam_kwargs = self.camera_kwargs.get(cam_type, {})
-            self.camera_dict[cam_id].set_reading_parameters(**curr_cam_kwargs)
+    def close(self):
+        for reader in self.camera_dict.values():
+            reader.disable_camera()
 
-            timestamp = timestamp_dict.get(cam_id + "_frame_received", None)
-            if index is not None:
-                self.camera_dict[cam_id].set_frame_index(index)
 
-            data_dict = self.camera_dict[cam_id].read_camera(correct_timestamp=timestamp)
 
-            # Process Returned Data #
-            if data_dict is None:
-                return None
-            for key in data_dict:
-                full_obs_dict[key].update(data_dict[key])
+def get_hdf5_length(hdf5_file, keys_to_ignore=[]):
+    # All datasets in a trajectory file share the same length, so return the first one found #
+    def _get_length(name, obj):
+        if any(key in keys_to_ignore for key in name.split("/")):
+            return None
+        if isinstance(obj, h5py.Dataset):
+            return obj.shape[0]
+        return None
 
-        return full_obs_dict
+    return hdf5_file.visititems(_get_length)
 
 
+def get_hdf5_datasets(hdf5_file):
+    # Collect (path keys, dataset) pairs for every dataset in a single pass over the group tree #
+    datasets = []
 
-def get_hdf5_length(hdf5_file, keys_to_ignore=[]):
-    length = None
+    def _collect(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            datasets.append((tuple(name.split("/")), obj))
 
-    for key in hdf5_file.keys():
-        if key in keys_to_ignore:
-            continue
+    hdf5_file.visititems(_collect)
+    return datasets
 
-        curr_data = hdf5_file[key]
-        if isinstance(curr_data, h5py.Group):
-            curr_length = get_hdf5_length(curr_data, keys_to_ignore=keys_to_ignore)
-        elif isinstance(curr_data, h5py.Dataset):
-            curr_length = len(curr_data)
-        else:
-            raise ValueError
 
-        if length is None:
-            length = curr_length
-        assert curr_length == length
+def set_nested_value(data_dict, keys, value):
+    for key in keys[:-1]:
+        data_dict = data_dict.setdefault(key, {})
+    data_dict[keys[-1]] = value
 
-    return length
 
+def read_hdf5_rows(dataset, indices):
+    if len(indices) == len(dataset):
+        return dataset[:]
+    if len(indices) == 0:
+        return dataset[:0]
 
-def load_hdf5_to_dict(hdf5_file, index, keys_to_ignore=[]):
-    data_dict = {}
+    # Read one contiguous slab covering all (sorted) requested rows, then select the rows in memory. #
+    # This avoids h5py fancy indexing, which issues a separate point selection per requested row.
+    start, stop = indices[0], indices[-1] + 1
+    return dataset[start:stop][np.asarray(indices) - start]
 
-    for key in hdf5_file.keys():
-        if key in keys_to_ignore:
-            continue
-
-        curr_data = hdf5_file[key]
-        if isinstance(curr_data, h5py.Group):
-            data_dict[key] = load_hdf5_to_dict(curr_data, index, keys_to_ignore=keys_to_ignore)
-        elif isinstance(curr_data, h5py.Dataset):
-            data_dict[key] = curr_data[index]
-        else:
-            raise ValueError
 
-    return data_dict
+def index_hdf5_dict(data_dict, index):
+    return {
+        key: index_hdf5_dict(value, index) if isinstance(value, dict) else value[index]
+        for key, value in data_dict.items()
+    }
 
 
 
 class TrajectoryReader:
     def __init__(self, filepath, read_images=True):
-        self._hdf5_file = h5py.File(filepath, "r")
+        # Use a chunk cache that holds a whole chunk (prime number of slots, as recommended by HDF5) #
+        # Each dataset is read once per trajectory, so the cache does not need to hold the whole working set.
+        self._hdf5_file = h5py.File(filepath, "r", rdcc_nbytes=64 * 1024 * 1024, rdcc_nslots=10007, rdcc_w0=0.75)
         is_video_folder = "observations/videos" in self._hdf5_file
         self._read_images = read_images and is_video_folder
         self._length = get_hdf5_length(self._hdf5_file)
         self._video_readers = {}
-        self._index = 0
+
+        # Cache The Dataset Tree Once, Since It Is The Same For Every Timestep #
+        self._datasets = get_hdf5_datasets(self._hdf5_file)
 
     def length(self):
         return self._length
 
-    def read_timestep(self, index=None, keys_to_ignore=[]):
+    def read_timesteps(self, indices, keys_to_ignore=[]):
         # Make Sure We Read Within Range #
-        if index is None:
-            index = self._index
-        else:
-            assert not self._read_images
-            self._index = index
-        assert index < self._length
+        assert not self._read_images
+        assert all(0 <= index < self._length for index in indices)
 
-        # Load Low Dimensional Data #
+        # Load Low Dimensional Data For All Indices At Once #
         keys_to_ignore = [*keys_to_ignore.copy(), "videos"]
-        timestep = load_hdf5_to_dict(self._hdf5_file, self._index, keys_to_ignore=keys_to_ignore)
+        traj_data = {}
+        for keys, dataset in self._get_datasets(keys_to_ignore):
+            set_nested_value(traj_data, keys, read_hdf5_rows(dataset, indices))
+        return traj_data
 
-        # Increment Read Index #
-        self._index += 1
-
-        # Return Timestep #
-        return timestep
+    def _get_datasets(self, keys_to_ignore):
+        return [(keys, dataset) for keys, dataset in self._datasets if not any(key in keys_to_ignore for key in keys)]
 
     def get_task_label(self):
         return self._hdf5_file.attrs['current_task']
@@ -252,8 +317,19 @@ def crawler(data_dirs, filter_func=None):
         if d == '':
             continue
         assert os.path.isdir(d), f"Not a directory: {d}"
-        folderpaths = os.path.join(d, 'success', '**', '**')
-        all_folderpaths += glob.glob(folderpaths)
+        success_dir = os.path.join(d, 'success')
+        if not os.path.isdir(success_dir):
+            continue
+        # Episodes live in <data_dir>/success/<date>/<episode>; only keep those with a trajectory and recordings #
+        with os.scandir(success_dir) as date_entries:
+            date_dirs = [e.path for e in date_entries if not e.name.startswith('.') and e.is_dir()]
+        for date_dir in date_dirs:
+            with os.scandir(date_dir) as episode_entries:
+                episode_dirs = [e.path for e in episode_entries if not e.name.startswith('.') and e.is_dir()]
+            all_folderpaths += [
+                p for p in episode_dirs
+                if os.path.exists(os.path.join(p, 'trajectory.h5')) and os.path.exists(os.path.join(p, 'recordings', 'MP4'))
+            ]
     all_folderpaths.sort()
     print(f"\nFound {len(all_folderpaths)} episodes.\n")
     return all_folderpaths
@@ -291,76 +367,243 @@ def load_trajectory(
     remove_skipped_steps=False,
     num_samples_per_traj=None,
     num_samples_per_traj_coeff=1.5,
+    timestep_queue=None,
+    video_device="cpu",
+    rng=None,
+    stop_event=None,
 ):
     read_hdf5_images = read_cameras and (recording_folderpath is None) # read images from hdf5 file
     read_recording_folderpath = read_cameras and (recording_folderpath is not None) # read images from MP4
 
+    # The camera_type dictionaries are incorrectly populated, so we overwrite them to contain the same camera IDs.
+    camera_type = {str(wrist_cam_id): 0, f"{wrist_cam_id}_depth": 0, str(static_cam_id): 1, f"{static_cam_id}_depth": 1}
+
     traj_reader = TrajectoryReader(filepath, read_images=read_hdf5_images)
-    if read_recording_folderpath:
-        camera_reader = RecordedMultiCameraWrapper(recording_folderpath, camera_kwargs)
-
-    horizon = traj_reader.length()
-    timestep_list = []
-
-    # Choose Timesteps To Save #
-    if num_samples_per_traj:
-        num_to_save = num_samples_per_traj
-        if remove_skipped_steps:
-            num_to_save = int(num_to_save * num_samples_per_traj_coeff)
-        max_size = min(num_to_save, horizon)
-        indices_to_save = np.sort(np.random.choice(horizon, size=max_size, replace=False))
-    else:
-        indices_to_save = np.arange(horizon)
-
-    # Iterate Over Trajectory #
-    for i in indices_to_save:
-        # Get HDF5 Data #
-        timestep = traj_reader.read_timestep(index=i)
-
-        # If Applicable, Get Recorded Data #
+    camera_reader = None
+    camera_images = None
+    try:
         if read_recording_folderpath:
-            timestamp_dict = timestep["observation"]["timestamp"]["cameras"]
-            # The camera_type dictionaries are incorrectly populated, so we overwrite them to contain the same camera IDs.
-            timestep["observation"]["camera_type"] = {str(wrist_cam_id): 0, f"{wrist_cam_id}_depth": 0, str(static_cam_id): 1, f"{static_cam_id}_depth": 1}
-            camera_type_dict = {
-                k: CAMERA_TYPE_TO_STRING_DICT[v] for k, v in timestep["observation"]["camera_type"].items()
-            }
-            camera_obs = camera_reader.read_cameras(
-                index=i, camera_type_dict=camera_type_dict, timestamp_dict=timestamp_dict
+            camera_type_dict = {k: CAMERA_TYPE_TO_STRING_DICT[v] for k, v in camera_type.items()}
+            camera_reader = RecordedMultiCameraWrapper(
+                recording_folderpath, camera_kwargs, camera_type_dict=camera_type_dict, device=video_device
             )
-            camera_failed = camera_obs is None
-
-            # Add Data To Timestep If Successful #
-            if camera_failed:
-                print(f"Failed to read camera")
-                break
-            else:
-                timestep["observation"].update(camera_obs)
-        
-        # Filter Steps #
-        step_skipped = not timestep["observation"]["controller_info"].get("movement_enabled", True)
-        delete_skipped_step = step_skipped and remove_skipped_steps
 
-        # Save Filtered Timesteps #
-        if delete_skipped_step:
-            del timestep
+        horizon = traj_reader.length()
+        timestep_list = []
+        kept_rows = []
+        if rng is None:
+            rng = np.random.default_rng()
+
+        # Choose Timesteps To Save #
+        if num_samples_per_traj:
+            num_to_save = num_samples_per_traj
+            if remove_skipped_steps:
+                num_to_save = int(num_to_save * num_samples_per_traj_coeff)
+            max_size = min(num_to_save, horizon)
+            indices_to_save = np.sort(rng.choice(horizon, size=max_size, replace=False))
         else:
-            timestep_list.append(timestep)
+            indices_to_save = np.arange(horizon)
 
-    # Remove Extra Transitions #
-    timestep_list = np.array(timestep_list)
-    if (num_samples_per_traj is not None) and (len(timestep_list) > num_samples_per_traj):
-        ind_to_keep = np.random.choice(len(timestep_list), size=num_samples_per_traj, replace=False)
-        timestep_list = timestep_list[ind_to_keep]
+        # Read HDF5 Data For All Saved Timesteps #
+        traj_data = traj_reader.read_timesteps(indices_to_save)
 
-    # Get Task Label #
-    task_label = traj_reader.get_task_label()
+        # If Applicable, Decode Recorded Frames Lazily, One Saved Timestep At A Time #
+        if read_recording_folderpath:
+            camera_images = camera_reader.iter_cameras(indices_to_save)
+
+        # Iterate Over Trajectory #
+        for k, i in enumerate(indices_to_save):
+            # Stop Early If The Consumer Gave Up #
+            if stop_event is not None and stop_event.is_set():
+                break
 
-    # Close Readers #
-    traj_reader.close()
+            # Get HDF5 Data #
+            timestep = index_hdf5_dict(traj_data, k)
+
+            # If Applicable, Get Recorded Data #
+            if read_recording_folderpath:
+                timestep["observation"]["camera_type"] = camera_type
+                images = next(camera_images, None)
+                camera_failed = images is None
+
+                # Add Data To Timestep If Successful #
+                if camera_failed:
+                    print(f"Failed to read camera")
+                    break
+                else:
+                    timestep["observation"]["image"] = images
+        
+            # Filter Steps #
+            step_skipped = not timestep["observation"]["controller_info"].get("movement_enabled", True)
+            delete_skipped_step = step_skipped and remove_skipped_steps
+
+            # Save Filtered Timesteps #
+            if delete_skipped_step:
+                del timestep
+            else:
+                timestep_list.append(timestep)
+                kept_rows.append(k)
+                if timestep_queue is not None:
+                    timestep_queue.put(timestep)
+
+        # Remove Extra Transitions #
+        if (num_samples_per_traj is not None) and (len(timestep_list) > num_samples_per_traj):
+            ind_to_keep = rng.choice(len(timestep_list), size=num_samples_per_traj, replace=False)
+            timestep_list = [timestep_list[i] for i in np.sort(ind_to_keep)] # keep the kept timesteps in temporal order
+            kept_rows = [kept_rows[i] for i in np.sort(ind_to_keep)]
+
+        # Get Task Label #
+        task_label = traj_reader.get_task_label()
+    finally:
+        # Close Readers (Also When Loading Fails, So Pool Workers Don't Leak Files And Decoder Threads) #
+        if camera_images is not None:
+            camera_images.close()
+        if camera_reader is not None:
+            camera_reader.close()
+        traj_reader.close()
+
+    # Keep Bulk (num_timesteps, ...) Arrays Of The Low Dimensional Data, Aligned With timestep_list #
+    traj_data = index_hdf5_dict(traj_data, np.asarray(kept_rows, dtype=np.int64))
 
     # Return Data #
-    return timestep_list, task_label
+    return timestep_list, task_label, traj_data
+
+
+def _encode_image(image):
+    # Encode to JPEG bytes here so that TFDS stores them directly instead of encoding the array itself.
+    if len(image.shape) == 3:
+        image = np.ascontiguousarray(image[..., ::-1]) # OpenCV expects BGR, which is a no-op for decoded RGB views
+    success, encoded_image = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    assert success
+    return encoded_image.tobytes()
+
+
+def _parse_example(episode_path, wrist_cam_id, static_cam_id):
+    FRAMESKIP = 1
+    PREFETCH_SIZE = 16
+
+    h5_filepath = os.path.join(episode_path, 'trajectory.h5')
+    recording_folderpath = os.path.join(episode_path, 'recordings', 'MP4')
+
+    # Load the trajectory in a background thread so that loading overlaps with image encoding.
+    # The bounded queue caps the number of loaded-but-not-yet-encoded timesteps held in memory.
+    timestep_queue = queue.Queue(maxsize=PREFETCH_SIZE)
+    stop_loading = threading.Event()
+    camera_kwargs = {cam_type: {'resolution': IMAGE_RESOLUTION} for cam_type in CAMERA_TYPE_TO_STRING_DICT.values()}
+    result = {}
+
+    def _load():
+        try:
+            result['traj'], result['task_label'], result['traj_data'] = load_trajectory(h5_filepath, wrist_cam_id=wrist_cam_id, static_cam_id=static_cam_id, read_cameras=True, recording_folderpath=recording_folderpath, camera_kwargs=camera_kwargs, timestep_queue=timestep_queue, video_device=VIDEO_DECODE_DEVICE, stop_event=stop_loading)
+        except Exception as e:
+            result['error'] = e
+        finally:
+            timestep_queue.put(None)
+
+    loader = threading.Thread(target=_load, daemon=True)
+    loader.start()
+
+    # Encode all images.
+    loader_done = False
+    try:
+        while True:
+            timestep = timestep_queue.get()
+            if timestep is None:
+                loader_done = True
+                break
+            for key in timestep['observation']['image'].keys():
+                timestep['observation']['image'][key] = _encode_image(timestep['observation']['image'][key])
+    finally:
+        if not loader_done:
+            # encoding was interrupted (including by KeyboardInterrupt), so stop the loader and drain the queue,
+            # so that it is not left blocked on a full queue
+            stop_loading.set()
+            while timestep_queue.get() is not None:
+                pass
+        loader.join()
+    if 'error' in result:
+        raise result['error']
+
+    traj, task_label = result['traj'], result['task_label']
+    data = traj[::FRAMESKIP]
+    traj_data = index_hdf5_dict(result['traj_data'], slice(None, None, FRAMESKIP))
+
+    if __debug__ and len(data) > 0:
+        assert data[-1].keys() == data[0].keys() # check that steps have the same dict keys
+
+    # Copy the bulk low-dimensional data into one preallocated per-episode float32 buffer, so each step only takes row views.
+    robot_state = traj_data['observation']['robot_state']
+    action = traj_data['action']
+    field_widths = [width for _, width in LOW_DIM_FIELDS]
+    low_dim_buffer = np.empty((len(data), sum(field_widths)), dtype=np.float32)
+    low_dim = dict(zip([name for name, _ in LOW_DIM_FIELDS], np.split(low_dim_buffer, np.cumsum(field_widths)[:-1], axis=1)))
+    low_dim['obs_cartesian_position'][:] = robot_state['cartesian_position']
+    low_dim['obs_joint_position'][:] = robot_state['joint_positions']
+    low_dim['obs_gripper_position'][:, 0] = robot_state['gripper_position']
+    low_dim['action_cartesian_position'][:] = action['cartesian_position']
+    low_dim['action_cartesian_velocity'][:] = action['cartesian_velocity']
+    low_dim['action_gripper_position'][:, 0] = action['gripper_position']
+    low_dim['action_gripper_velocity'][:, 0] = action['gripper_velocity']
+    low_dim['action_joint_position'][:] = action['joint_position']
+    low_dim['action_joint_velocity'][:] = action['joint_velocity']
+
+    np.concatenate([low_dim['action_cartesian_position'], low_dim['action_gripper_position']], axis=1, out=low_dim['action_all'])
+
+    # Precompute per-step flags for the whole episode --> here we're assuming demos so we set reward to 1 at the end
+    is_first = np.zeros(len(data), dtype=np.bool_)
+    is_first[:1] = True
+    is_last = np.zeros(len(data), dtype=np.bool_)
+    is_last[-1:] = True
+    reward = is_last.astype(np.float32)
+    language_instruction = f"{task_label}"
+
+    # camera types are the same for every step, so look up the camera ids once
+    camera_type_dict = data[0]['observation']['camera_type'] if len(data) > 0 else {}
+    wrist_cam_ids = [f'{k}' for k, v in camera_type_dict.items() if v == 0]
+    static_cam_ids = [f'{k}' for k, v in camera_type_dict.items() if v != 0]
+
+    def _make_step(i):
+        obs = data[i]['observation']
+
+        return {
+            'observation': {
+                'wrist_image': obs['image'][wrist_cam_ids[0]],
+                'wrist_depth_image': obs['image'][wrist_cam_ids[1]],
+                'static_image': obs['image'][static_cam_ids[0]],
+                'static_depth_image': obs['image'][static_cam_ids[1]],
+                'cartesian_position': low_dim['obs_cartesian_position'][i],
+                'joint_position': low_dim['obs_joint_position'][i],
+                'gripper_position': low_dim['obs_gripper_position'][i],
+            },
+            'action_dict': {
+                'cartesian_position': low_dim['action_cartesian_position'][i],
+                'cartesian_velocity': low_dim['action_cartesian_velocity'][i],
+                'gripper_position': low_dim['action_gripper_position'][i],
+                'gripper_velocity': low_dim['action_gripper_velocity'][i],
+                'joint_position': low_dim['action_joint_position'][i],
+                'joint_velocity': low_dim['action_joint_velocity'][i],
+            },
+            'action': low_dim['action_all'][i],
+            'discount': 1.0,
+            'reward': reward[i],
+            'is_first': is_first[i],
+            'is_last': is_last[i],
+            'is_terminal': is_last[i],
+            'language_instruction': language_instruction,
+        }
+
+    # assemble episode
+    episode = list(map(_make_step, range(len(data))))
+    # create output data sample
+    sample = {
+        'steps': episode,
+        'episode_metadata': {
+            'file_path': h5_filepath,
+            'recording_folderpath': recording_folderpath
+        }
+    }
+    # if you want to skip an example for whatever reason, simply return None
+    return episode_path, sample
 
 
 class TDROIDCoverObjectWithTowel(tfds.core.GeneratorBasedBuilder):
@@ -507,94 +750,29 @@ class TDROIDCoverObjectWithTowel(tfds.core.GeneratorBasedBuilder):
     def _generate_examples(self, data_dirs, wrist_cam_id, static_cam_id) -> Iterator[Tuple[str, Any]]:
         """Generator of examples for each split."""
 
-        def _resize_and_encode(image, size):
-            assert len(size) == 2
-            # In PIL, image size is (W, H, C) as opposed to (H, W, C), so flip the size if needed.
-            if size[0] < size[1]:
-                size = size[::-1]
-            image = Image.fromarray(image)
-            image = image.resize(size, Image.Resampling.LANCZOS)
-            image = np.array(image)
-            if len(image.shape) == 2:
-                image = np.expand_dims(image, axis=-1) # (H, W) to (H, W, 1)
-            return image
-
-        def _parse_example(episode_path):
-            FRAMESKIP = 1
-
-            h5_filepath = os.path.join(episode_path, 'trajectory.h5')
-            recording_folderpath = os.path.join(episode_path, 'recordings', 'MP4')
-
-            traj, task_label = load_trajectory(h5_filepath, wrist_cam_id=wrist_cam_id, static_cam_id=static_cam_id, read_cameras=True, recording_folderpath=recording_folderpath)
-            data = traj[::FRAMESKIP]
-
-            assert all(t.keys() == data[0].keys() for t in data) # check that all steps have the same dict keys
-            # Resize and encode all images.
-            for t in range(len(data)):
-                for key in data[0]['observation']['image'].keys():
-                    data[t]['observation']['image'][key] = _resize_and_encode(data[t]['observation']['image'][key], size=(270, 360))
-
-            # assemble episode --> here we're assuming demos so we set reward to 1 at the end
-            episode = []
-            for i, step in enumerate(data):
-                obs = step['observation']
-                action = step['action']
-                language_instruction = f"{task_label}"
-                camera_type_dict = obs['camera_type']
-                wrist_cam_ids = [k for k, v in camera_type_dict.items() if v == 0]
-                static_cam_ids = [k for k, v in camera_type_dict.items() if v != 0]
-
-                episode.append({
-                    'observation': {
-                        'wrist_image': obs['image'][f'{wrist_cam_ids[0]}'],
-                        'wrist_depth_image': obs['image'][f'{wrist_cam_ids[1]}'],
-                        'static_image': obs['image'][f'{static_cam_ids[0]}'],
-                        'static_depth_image': obs['image'][f'{static_cam_ids[1]}'],
-                        'cartesian_position': np.array(obs['robot_state']['cartesian_position'], dtype=np.float32),
-                        'joint_position': np.array(obs['robot_state']['joint_positions'], dtype=np.float32),
-                        'gripper_position': np.array([obs['robot_state']['gripper_position']], dtype=np.float32),
-                    },
-                    'action_dict': {
-                        'cartesian_position': np.array(action['cartesian_position'], dtype=np.float32),
-                        'cartesian_velocity': np.array(action['cartesian_velocity'], dtype=np.float32),
-                        'gripper_position': np.array([action['gripper_position']], dtype=np.float32),
-                        'gripper_velocity': np.array([action['gripper_velocity']], dtype=np.float32),
-                        'joint_position': np.array(action['joint_position'], dtype=np.float32),
-                        'joint_velocity': np.array(action['joint_velocity'], dtype=np.float32),
-                    },
-                    'action': np.concatenate((action['cartesian_position'], [action['gripper_position']]), dtype=np.float32),
-                    'discount': 1.0,
-                    'reward': float(i == (len(data) - 1)),
-                    'is_first': i == 0,
-                    'is_last': i == (len(data) - 1),
-                    'is_terminal': i == (len(data) - 1),
-                    'language_instruction': language_instruction,
-                })
-            # create output data sample
-            sample = {
-                'steps': episode,
-                'episode_metadata': {
-                    'file_path': h5_filepath,
-                    'recording_folderpath': recording_folderpath
-                }
-            }
-            # if you want to skip an example for whatever reason, simply return None
-            return episode_path, sample
-
         # create list of all examples
         episode_paths = crawler(data_dirs)
-        episode_paths = [p for p in episode_paths if os.path.exists(p + '/trajectory.h5') and \
-                os.path.exists(p + '/recordings/MP4')]
 
-        # for smallish datasets, use single-thread parsing
-        for sample in episode_paths:
-            yield _parse_example(sample)
+        # episodes are independent, so parse them in parallel worker processes and yield each as soon as it is done
+        parse_fn = partial(_parse_example, wrist_cam_id=wrist_cam_id, static_cam_id=static_cam_id)
+        # each worker runs OpenCV (resize, cvtColor) single-threaded, since the pool already uses every core
+        max_workers = os.cpu_count() if VIDEO_DECODE_DEVICE == "cpu" else CUDA_DECODE_WORKERS
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=cv2.setNumThreads, initargs=(1,)) as executor:
+            # keep a bounded window of episodes in flight, so finished episodes don't pile up in memory before TFDS consumes them
+            episode_iter = iter(episode_paths)
+            pending = {executor.submit(parse_fn, episode_path) for episode_path in islice(episode_iter, 2 * max_workers)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    for episode_path in islice(episode_iter, 1):
+                        pending.add(executor.submit(parse_fn, episode_path))
 
         # # for large datasets use beam to parallelize data parsing (this will have initialization overhead)
         # beam = tfds.core.lazy_imports.apache_beam
         # return (
         #         beam.Create(episode_paths)
-        #         | beam.Map(_parse_example)
+        #         | beam.Map(parse_fn)
         # )
 
 